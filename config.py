@@ -1,47 +1,224 @@
 import os
 import json
+import signal
+import logging
+import threading
+from collections import namedtuple
+from timeservice import DEFAULT_MAX_ERROR
+from locationservice import DEFAULT_CACHE_FILE, DEFAULT_TTL
+from filesync import DEFAULT_MANIFEST_FILE
+
+DEFAULT_SOCKET_PATH = '/tmp/sim7080.sock'
+
+# what a change of a setting requires to take effect
+APPLY_IMMEDIATE = 'immediate'
+APPLY_MQTT_RECONNECT = 'mqtt_reconnect'
+APPLY_NETWORK_RECONNECT = 'network_reconnect'
+APPLY_RESTART = 'restart'
+
+REQUIRED = object()
+
+Setting = namedtuple('Setting', ['type', 'default', 'apply', 'check'])
+
+
+def _setting(type, default=REQUIRED, apply=APPLY_IMMEDIATE, check=None):
+    return Setting(type, default, apply, check)
+
+
+def _positive(value):
+    return value > 0
+
+
+class ConfigError(ValueError):
+    pass
+
 
 class Config():
 
-    _keys = ['mqtt_server_host',
-            'mqtt_server_port',
-            'mqtt_clientid',
-            'mqtt_user',
-            'mqtt_password',
-            'mqtt_keeptime',
-            'mqtt_cleanss',
-            'mqtt_qos',
-            'mqtt_auth_type',
-            'mqtt_public_topic',
-            'mqtt_client_id',
-            'mobile_catm_nbiot',
-            'mobile_apn',
-            'serial_port',
-            'serial_baud',
-            'serial_default_timeout',
-            'ntp_server_host']
+    schema = {
+        'mqtt_host': _setting(str, apply=APPLY_MQTT_RECONNECT),
+        'mqtt_port': _setting(
+            int, 8883, APPLY_MQTT_RECONNECT, lambda v: 0 < v < 65536),
+        'mqtt_clientid': _setting(str, apply=APPLY_MQTT_RECONNECT),
+        'mqtt_user': _setting(str, '', APPLY_MQTT_RECONNECT),
+        'mqtt_password': _setting(str, '', APPLY_MQTT_RECONNECT),
+        'mqtt_keeptime': _setting(int, 60, APPLY_MQTT_RECONNECT, _positive),
+        'mqtt_cleanss': _setting(int, 1, APPLY_MQTT_RECONNECT, lambda v: v in (0, 1)),
+        'mqtt_qos': _setting(int, 1, APPLY_MQTT_RECONNECT, lambda v: v in (0, 1, 2)),
+        'mqtt_ca_crt_filename': _setting(str, 'ca.crt', APPLY_MQTT_RECONNECT),
+        'mqtt_client_cert_filename': _setting(str, 'client.crt', APPLY_MQTT_RECONNECT),
+        'mqtt_client_key_filename': _setting(str, 'client.key', APPLY_MQTT_RECONNECT),
+        'mqtt_publish_topic': _setting(str),
+        'mqtt_batch_size': _setting(int, 50, check=_positive),
+        'mobile_catm_nbiot': _setting(
+            int, 1, APPLY_NETWORK_RECONNECT, lambda v: v in (1, 2, 3)),
+        'mobile_apn': _setting(str, '', APPLY_NETWORK_RECONNECT),
+        'serial_port': _setting(str, apply=APPLY_RESTART),
+        'serial_baud': _setting(int, 9600, APPLY_RESTART, _positive),
+        'serial_default_timeout': _setting(float, 1, APPLY_RESTART, _positive),
+        'ntp_server_host': _setting(str, 'pool.ntp.org'),
+        'time_max_error': _setting(float, DEFAULT_MAX_ERROR, check=_positive),
+        'location_cache_file': _setting(str, DEFAULT_CACHE_FILE, APPLY_RESTART),
+        'location_cache_ttl': _setting(int, DEFAULT_TTL, check=_positive),
+        'file_manifest': _setting(str, DEFAULT_MANIFEST_FILE, APPLY_RESTART),
+        'daemon_socket_path': _setting(str, DEFAULT_SOCKET_PATH, APPLY_RESTART),
+    }
+
+    # old names still found in settings files
+    aliases = {
+        'mqtt_server_host': 'mqtt_host',
+        'mqtt_server_port': 'mqtt_port',
+        'mqtt_public_topic': 'mqtt_publish_topic',
+        'mqtt_client_id': 'mqtt_clientid',
+    }
 
     def __init__(self, filename):
         self.filename = filename
         self.store = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._mtime = None
+        self._reload_requested = threading.Event()
+        self._watcher = None
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
 
     def load_config(self):
         """
         Load config from file and environment
         :return:
         """
-        self._load_from_file(self.filename)
-        self._update_config_from_environment()
-        return self.store
+        self.store = self._read()
+        return self
+
+    def reload(self):
+        """
+        Load config again and notify listeners about changed settings.
+        An invalid config is logged and the current one is kept.
+        :return: dict of changed keys -> (old value, new value)
+        """
+        try:
+            store = self._read()
+        except (OSError, ValueError) as e:
+            self.logger.error(f'not reloading invalid config: {e}')
+            return {}
+        with self._lock:
+            changed = {
+                key: (self.store.get(key), value)
+                for key, value in store.items()
+                if self.store.get(key) != value
+            }
+            self.store = store
+        if not changed:
+            return changed
+        self.logger.info(f'config changed: {sorted(changed)}')
+        for listener in self._listeners:
+            try:
+                listener(changed)
+            except Exception:
+                self.logger.exception('failed to apply config change:')
+        return changed
+
+    def subscribe(self, listener):
+        """listener is called with the dict of changes after each reload."""
+        self._listeners.append(listener)
+
+    @classmethod
+    def changes_by_apply(cls, changed):
+        """Groups changed keys by what they require to take effect."""
+        groups = {}
+        for key in changed:
+            groups.setdefault(cls.schema[key].apply, []).append(key)
+        return groups
+
+    def watch(self, interval=5):
+        """Reloads on file change or SIGHUP. Call from the main thread."""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._reload_requested.set())
+        self._watcher = threading.Thread(
+            target=self._watch, args=(interval,), name='ConfigWatcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            requested = self._reload_requested.wait(interval)
+            self._reload_requested.clear()
+            try:
+                mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                continue
+            if requested or mtime != self._mtime:
+                # a dead watcher would silently end hot reload
+                try:
+                    self.reload()
+                except Exception:
+                    self.logger.exception('config reload failed:')
+
+    def _read(self):
+        store = self._load_from_file(self.filename)
+        self._update_config_from_environment(store)
+        return self._validate(store)
 
     def _load_from_file(self, filename):
-        print('Loading settings from %s' % filename)
-        self.store = json.loads(open(filename).read())
+        self.logger.info('Loading settings from %s' % filename)
+        self._mtime = os.stat(filename).st_mtime
+        with open(filename) as f:
+            raw = json.load(f)
+        if not isinstance(raw, dict):
+            raise ConfigError(f'{filename} must contain a json object')
+        store = {}
+        for key, value in raw.items():
+            if key in self.aliases:
+                new_key = self.aliases[key]
+                if new_key in raw:
+                    raise ConfigError(
+                        f'{filename} sets both {key} and {new_key}, remove {key}')
+                self.logger.warning(f'setting {key} is deprecated, use {new_key}')
+                key = new_key
+            store[key] = value
+        return store
 
-    def _update_config_from_environment(self):
-        from_env = {}
-        for key in self._keys:
+    def _update_config_from_environment(self, store):
+        # environment values are strings, convert them to the setting's type
+        for key, setting in self.schema.items():
             env = os.environ.get(key.upper(), None)
             if env:
-                from_env[key] = env
-        self.store.update(from_env)
\ No newline at end of file
+                try:
+                    store[key] = setting.type(env)
+                except ValueError:
+                    raise ConfigError(
+                        f'invalid {setting.type.__name__} for {key.upper()}: {env!r}')
+
+    def _validate(self, store):
+        unknown = set(store) - set(self.schema)
+        if unknown:
+            self.logger.warning(f'ignoring unknown settings: {sorted(unknown)}')
+        validated = {}
+        for key, setting in self.schema.items():
+            if key not in store:
+                if setting.default is REQUIRED:
+                    raise ConfigError(f'missing setting: {key}')
+                validated[key] = setting.default
+                continue
+            value = store[key]
+            if not self._has_type(value, setting.type):
+                raise ConfigError(
+                    f'invalid {setting.type.__name__} for {key}: {value!r}')
+            value = setting.type(value)
+            if setting.check is not None and not setting.check(value):
+                raise ConfigError(f'value out of range for {key}: {value!r}')
+            validated[key] = value
+        return validated
+
+    @staticmethod
+    def _has_type(value, type):
+        # bool is an int in python, but never a valid number here
+        if isinstance(value, bool):
+            return False
+        if type is float:
+            return isinstance(value, (int, float))
+        return isinstance(value, type)
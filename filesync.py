@@ -0,0 +1,114 @@
+"""This module keeps files on the sim7080 file system in sync with local
+files, e.g. the certificates and key used for mqtts.
+
+A host-side manifest records the sha256 and size of every file uploaded
+to the module. A file is only uploaded again if its local content
+changed or the module reports a different size (missing or partially
+written), and all files are handled in a single AT+CFSINIT session."""
+
+import os
+import json
+import hashlib
+import logging
+
+DEFAULT_MANIFEST_FILE = 'modem_files.json'
+
+
+class FileSync():
+
+    UNCHANGED = 'unchanged'
+    UPLOADED = 'uploaded'
+    FAILED = 'failed'
+    MISSING = 'missing'
+
+    def __init__(self, modem, manifest_file=DEFAULT_MANIFEST_FILE):
+        self.modem = modem
+        self.manifest_file = manifest_file
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.manifest = self._load()
+
+    def sync(self, filenames, verify=False, force=False):
+        """Uploads files that are missing or changed on the module.
+
+        Each entry is either a filename, used as local path and name on
+        the module, or a (name on the module, local path) pair.
+        With verify, files that look current are read back and hashed
+        instead of only comparing the size. With force, every file is
+        uploaded. Returns a dict of name on the module -> UNCHANGED,
+        UPLOADED, FAILED or MISSING (no readable local file).
+        """
+        self.logger.info('*'*8 + ' sync files ' + '*'*8)
+        results = {}
+        try:
+            with self.modem.file_session():
+                for filename in filenames:
+                    if isinstance(filename, str):
+                        remote_name, local_path = filename, filename
+                    else:
+                        remote_name, local_path = filename
+                    results[remote_name] = self._sync_file(
+                        remote_name, local_path, verify, force)
+        finally:
+            self._save()
+        self.logger.info(f'sync result: {results}')
+        return results
+
+    def delete(self, filenames):
+        with self.modem.file_session():
+            for filename in filenames:
+                self.modem.delete_file(filename)
+                self.manifest.pop(filename, None)
+        self._save()
+        return True
+
+    def _sync_file(self, filename, local_path, verify, force):
+        try:
+            with open(local_path, 'rb') as f:
+                content = f.read()
+        except OSError as e:
+            # nothing to compare with, leave the module's copy alone
+            self.logger.warning(f'can\'t read local file for {filename}: {e}')
+            return self.MISSING
+        entry = {
+            'sha256': hashlib.sha256(content).hexdigest(),
+            'size': len(content),
+        }
+        if not force and self.manifest.get(filename) == entry:
+            if self._is_current(filename, entry, verify):
+                self.logger.info(f'file: {filename} is up to date.')
+                return self.UNCHANGED
+            self.logger.info(f'file: {filename} differs on module.')
+        # forget the old state first, an interrupted upload leaves no
+        # entry and is retried next time
+        self.manifest.pop(filename, None)
+        if (not self.modem.write_file(local_path, remote_name=filename)
+                or self.modem.get_file_size(filename) != entry['size']):
+            self.logger.error(f'upload of {filename} failed.')
+            return self.FAILED
+        self.manifest[filename] = entry
+        return self.UPLOADED
+
+    def _is_current(self, filename, entry, verify):
+        if self.modem.get_file_size(filename) != entry['size']:
+            return False
+        if not verify:
+            return True
+        content = self.modem.read_file(filename, entry['size'])
+        return (content is not None
+                and hashlib.sha256(content).hexdigest() == entry['sha256'])
+
+    def _load(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            self.logger.exception(f'failed to load {self.manifest_file}:')
+            return {}
+
+    def _save(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
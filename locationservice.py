@@ -0,0 +1,180 @@
+"""This module caches base station locations by serving cell.
+
+A lookup with AT+CLBS costs a network round trip of up to 10 seconds,
+while the serving cell (AT+CPSI?) is known locally. Gateways rarely move,
+so positions are kept per cell in a persistent cache and only looked up
+again, in the background, when the cell changes or an entry expires."""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from scheduler import PRIORITY
+
+DEFAULT_CACHE_FILE = 'location_cache.json'
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 64
+# don't spend airtime on a cell whose lookup just failed
+RETRY_INTERVAL = 600
+
+
+class LocationService():
+
+    def __init__(
+        self,
+        modem,
+        scheduler,
+        cache_file=DEFAULT_CACHE_FILE,
+        ttl=DEFAULT_TTL,
+        max_entries=DEFAULT_MAX_ENTRIES
+    ):
+        self.modem = modem
+        self.scheduler = scheduler
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        # cell key -> {'position': ..., 'updated': epoch seconds}, lru first
+        self._cache = OrderedDict()
+        self._refreshing = set()
+        # cell key -> monotonic time of the last failed lookup
+        self._failed = {}
+        self._load()
+
+    def get_location(self, wait=False):
+        """Returns the position of the serving cell. Needs modem access.
+
+        A cached position is returned right away, even if it expired; a
+        refresh is then queued as bulk work. Without a cached position
+        None is returned unless wait is True, in which case the lookup
+        is done right away.
+        """
+        cell = self.modem.get_serving_cell()
+        if cell is None:
+            self.logger.info('no serving cell, can\'t look up location.')
+            return None
+        key = '/'.join(cell)
+        moved = False
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and next(reversed(self._cache)) != key:
+                self._cache.move_to_end(key)
+                moved = True
+        if moved:
+            # keep the lru order on disk, the cell rarely changes
+            self._save()
+        if entry is None and wait:
+            return self._refresh(key)
+        if entry is None or self._is_expired(entry):
+            self._schedule_refresh(key)
+        if entry is None:
+            self.logger.info(f'no cached location for cell {key}.')
+            return None
+        return entry['position']
+
+    def _is_expired(self, entry):
+        return time.time() - entry['updated'] > self.ttl
+
+    def _schedule_refresh(self, key):
+        with self._lock:
+            now = time.monotonic()
+            # forget failures that no longer hold back a retry
+            for failed_key, failed in list(self._failed.items()):
+                if now - failed >= RETRY_INTERVAL:
+                    del self._failed[failed_key]
+            if key in self._failed:
+                return
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        try:
+            # never block, this may run on the scheduler's own worker
+            future = self.scheduler.submit(
+                lambda modem: self._refresh(key),
+                PRIORITY.BULK,
+                producer='location',
+                block=False
+            )
+        except queue.Full:
+            self.logger.info(f'queue full, skipping location refresh of {key}.')
+            with self._lock:
+                self._refreshing.discard(key)
+            return
+        future.add_done_callback(self._log_refresh_error)
+
+    def _log_refresh_error(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        self.logger.error(
+            'location refresh failed:', exc_info=future.exception())
+
+    def _refresh(self, key):
+        try:
+            cell = self.modem.get_serving_cell()
+            if cell is None or '/'.join(cell) != key:
+                # moved on in the meantime, the next request will ask again
+                return None
+            position = self.modem.get_location()
+            if position is None:
+                with self._lock:
+                    self._failed[key] = time.monotonic()
+                return None
+            with self._lock:
+                self._failed.pop(key, None)
+                self._cache[key] = {'position': position, 'updated': time.time()}
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            self._save()
+            return position
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            self.logger.exception(f'failed to load {self.cache_file}:')
+            return
+        if not self._is_valid(entries):
+            self.logger.error(f'ignoring {self.cache_file}, unexpected format.')
+            return
+        # expired entries are kept, they still beat no position at all
+        for key, entry in entries[-self.max_entries:]:
+            self._cache[key] = entry
+        self.logger.info(f'loaded {len(self._cache)} cached locations.')
+
+    def _is_valid(self, entries):
+        """Checks for a list of [key, {'position': ..., 'updated': ...}]."""
+        if not isinstance(entries, list):
+            return False
+        for item in entries:
+            if not (isinstance(item, list) and len(item) == 2):
+                return False
+            key, entry = item
+            if not (isinstance(key, str) and isinstance(entry, dict)):
+                return False
+            if (not isinstance(entry.get('updated'), (int, float))
+                    or 'position' not in entry):
+                return False
+        return True
+
+    def _save(self):
+        with self._lock:
+            entries = list(self._cache.items())
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            # the cache in memory is still good
+            self.logger.exception(f'failed to save {self.cache_file}:')
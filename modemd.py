@@ -0,0 +1,418 @@
+"""This module keeps a warm sim7080 modem session in a long-running daemon
+and serves requests from the redis2mqtt cli over a unix domain socket."""
+
+import os
+import json
+import time
+import socket
+import logging
+import socketserver
+from itertools import count
+from sim7080 import MODEM_STATUS, FILE_CHUNK_SIZE, DOWNLOAD_FILENAME
+from scheduler import CommandScheduler, PRIORITY
+from timeservice import TimeService
+from locationservice import LocationService
+from filesync import FileSync
+from config import (
+    Config, DEFAULT_SOCKET_PATH,
+    APPLY_MQTT_RECONNECT, APPLY_NETWORK_RECONNECT, APPLY_RESTART)
+
+NETWORK_ATTEMPTS = 3
+NETWORK_RETRY_DELAY = 10
+MQTT_ATTEMPTS = 3
+# a daemon that doesn't accept or answer a ping within this is wedged
+DEFAULT_CONNECT_TIMEOUT = 5
+
+
+class ModemServiceError(Exception):
+    pass
+
+
+class ModemService():
+    """Operations on a Sim7080 modem, addressable by command name.
+
+    The same commands are used by the cli directly (no daemon running)
+    and by the daemon on behalf of its clients. All results are json
+    serializable so they can be sent over the control socket.
+    Handlers run on the caller's thread and get a run() function that
+    executes one modem transaction through the CommandScheduler, with
+    the command's priority class. Long operations are split into several
+    transactions (network attach, file sync, mqtt connect and publish,
+    one per download chunk) so other work can run in between, and waits
+    between retries happen outside the scheduler.
+    """
+
+    def __init__(self, modem, config, scheduler=None):
+        self.modem = modem
+        self.config = config
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # a single attach attempt per transaction, the retries are ours
+        self.modem.network_attempts = 1
+        if scheduler is None:
+            scheduler = CommandScheduler(modem)
+        self.scheduler = scheduler
+        self.scheduler.start()
+        self.time_service = TimeService(
+            modem,
+            config['ntp_server_host'],
+            max_error=config['time_max_error']
+        )
+        self.location_service = LocationService(
+            modem,
+            self.scheduler,
+            cache_file=config['location_cache_file'],
+            ttl=config['location_cache_ttl']
+        )
+        self.file_sync = FileSync(modem, config['file_manifest'])
+        # command -> (handler, default priority)
+        self._commands = {
+            'ping': (self.ping, PRIORITY.CONTROL),
+            'status': (self.status, PRIORITY.CONTROL),
+            'power_down': (self.power_down, PRIORITY.CONTROL),
+            'get_ntp_time': (self.get_ntp_time, PRIORITY.CONTROL),
+            'get_time': (self.get_time, PRIORITY.CONTROL),
+            'get_location': (self.get_location, PRIORITY.INTERACTIVE),
+            'write_file': (self.write_file, PRIORITY.INTERACTIVE),
+            'sync_files': (self.sync_files, PRIORITY.INTERACTIVE),
+            'delete_file': (self.delete_file, PRIORITY.INTERACTIVE),
+            'download_file': (self.download_file, PRIORITY.BULK),
+            'publish': (self.publish, PRIORITY.BULK),
+            'publish_batch': (self.publish_batch, PRIORITY.BULK),
+        }
+
+    def call(self, command, priority=None, producer='default', **params):
+        if command not in self._commands:
+            raise ModemServiceError(f'unknown command: {command}')
+        handler, default_priority = self._commands[command]
+        if command == 'get_time' and not self.time_service.should_sync():
+            # answered from the cached offset, no need to wait for the modem
+            return self.time_service.now_us()
+        if priority is None:
+            priority = default_priority
+        elif isinstance(priority, str):
+            priority = PRIORITY[priority.upper()]
+
+        def run(transaction):
+            return self.scheduler.run(transaction, priority, producer)
+        return handler(run, **params)
+
+    def ping(self, run):
+        return 'pong'
+
+    def status(self, run):
+        return run(lambda modem: modem.modem_status.name)
+
+    def write_file(self, run, filename, remote_name=None):
+        if remote_name is None:
+            remote_name = filename
+        result = run(lambda modem: self.file_sync.sync(
+            [(remote_name, filename)], force=True))
+        return result[remote_name] == FileSync.UPLOADED
+
+    def sync_files(self, run, filenames, verify=False, force=False):
+        # one transaction, so all files share a single file system session
+        return run(lambda modem: self.file_sync.sync(
+            filenames, verify=verify, force=force))
+
+    def delete_file(self, run, filename):
+        return run(lambda modem: self.file_sync.delete([filename]))
+
+    def download_file(self, run, url, filename=DOWNLOAD_FILENAME):
+        self._ensure_network(run)
+        data_length = run(lambda modem: modem.http_request(url))
+        if data_length is None:
+            return False
+        with open(filename, 'wb') as f:
+            start_idx = 0
+            while start_idx < data_length:
+                size = min(FILE_CHUNK_SIZE, data_length - start_idx)
+                data = run(lambda modem: modem.http_read(start_idx, size))
+                if data is None:
+                    self.logger.warning(f'download of {url} failed.')
+                    return False
+                f.write(data)
+                start_idx += size
+        return True
+
+    def get_ntp_time(self, run):
+        self._ensure_network(run)
+        curr_time = run(
+            lambda modem: modem.get_ntp_time(self.config['ntp_server_host']))
+        return curr_time.isoformat() if curr_time else None
+
+    def get_time(self, run):
+        """Current time in microseconds since the epoch, None if unknown."""
+        if self.time_service.should_sync():
+            run(lambda modem: self.time_service.sync())
+        return self.time_service.now_us()
+
+    def get_location(self, run, wait=False):
+        return run(lambda modem: self.location_service.get_location(wait=wait))
+
+    def publish(self, run, message, topic=None):
+        if topic is None:
+            topic = self.config['mqtt_publish_topic']
+        for attempt in range(2):
+            self._ensure_mqtt(run)
+            if run(lambda modem: modem.mqtt_publish(topic, message)):
+                return True
+            # the session may have dropped since the last request
+            self.logger.info('publish failed. re-syncing modem status..')
+            run(lambda modem: modem._sync_modem_status())
+        return False
+
+    def publish_batch(self, run, messages, topic=None):
+        """Publishes messages as json arrays of mqtt_batch_size entries.
+
+        The batch size is read for every batch, so a config reload applies
+        right away. Stops at the first failed batch and returns the number
+        of messages published.
+        """
+        published = 0
+        while published < len(messages):
+            batch = messages[published:published + self.config['mqtt_batch_size']]
+            if not self.publish(run, json.dumps(batch), topic):
+                break
+            published += len(batch)
+        return published
+
+    def _ensure_network(self, run):
+        for i in range(NETWORK_ATTEMPTS):
+            if run(self._connect_network):
+                return
+            # wait outside the scheduler, so other work can go on
+            self.logger.info(f'no network, trying again in {NETWORK_RETRY_DELAY}s..')
+            time.sleep(NETWORK_RETRY_DELAY)
+        raise ModemServiceError('no network connection')
+
+    def _connect_network(self, modem):
+        modem._sync_modem_status()
+        if modem.modem_status >= MODEM_STATUS.NETWORK_CONNECTED:
+            return True
+        modem.ensure_power()
+        return modem.connect_network(
+            apn_name=self.config['mobile_apn'],
+            preferred_mode=self.config['mobile_catm_nbiot'])
+
+    def _ensure_mqtt(self, run):
+        self._ensure_network(run)
+        if self.modem.modem_status == MODEM_STATUS.MQTT_CONNECTED:
+            return
+        certificates = [
+            self.config['mqtt_ca_crt_filename'],
+            self.config['mqtt_client_cert_filename'],
+            self.config['mqtt_client_key_filename'],
+        ]
+        # make sure current certificates are on the module before
+        # converting them, files missing on the host are skipped
+        run(lambda modem: self.file_sync.sync(certificates))
+        for i in range(MQTT_ATTEMPTS):
+            if run(self._connect_mqtt):
+                return
+        raise ModemServiceError('connection to mqtt failed')
+
+    def _connect_mqtt(self, modem):
+        return modem.connect_mqtt(
+            self.config['mqtt_host'],
+            self.config['mqtt_port'],
+            self.config['mqtt_clientid'],
+            self.config['mqtt_ca_crt_filename'],
+            self.config['mqtt_client_cert_filename'],
+            self.config['mqtt_client_key_filename'],
+            self.config['mqtt_qos'],
+            username=self.config['mqtt_user'],
+            password=self.config['mqtt_password'],
+            keeptime=self.config['mqtt_keeptime'],
+            cleanss=self.config['mqtt_cleanss']
+        )
+
+    def power_down(self, run):
+        return run(lambda modem: modem.power_down())
+
+    def apply_config_changes(self, changed):
+        """Applies reloaded settings without tearing down the session.
+
+        Settings read on every use (topic, batch size, ...) already took
+        effect. Broker and apn changes drop the mqtt or network connection,
+        which is set up again with the new settings on the next publish.
+        """
+        groups = Config.changes_by_apply(changed)
+        if 'time_max_error' in changed:
+            self.time_service.max_error = self.config['time_max_error']
+        if 'ntp_server_host' in changed:
+            self.time_service.ntp_server = self.config['ntp_server_host']
+        if 'location_cache_ttl' in changed:
+            self.location_service.ttl = self.config['location_cache_ttl']
+        if APPLY_RESTART in groups:
+            self.logger.warning(
+                f'changes to {groups[APPLY_RESTART]} take effect after restart.')
+        if APPLY_NETWORK_RECONNECT in groups:
+            self.logger.info('network settings changed, reconnecting..')
+            self.scheduler.submit(
+                lambda modem: modem.disconnect_network(),
+                PRIORITY.CONTROL, producer='config')
+        elif APPLY_MQTT_RECONNECT in groups:
+            self.logger.info('mqtt settings changed, reconnecting..')
+            self.scheduler.submit(
+                lambda modem: modem.disconnect_mqtt(),
+                PRIORITY.CONTROL, producer='config')
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection.
+
+    Requests and responses are json documents, one per line. A client
+    may write several requests before reading the responses; they are
+    answered in order.
+    """
+
+    def handle(self):
+        # used for requests that don't name their producer
+        connection = f'client-{next(self.server.client_ids)}'
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.modem_daemon.handle_request(line, connection)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ModemDaemon():
+
+    def __init__(self, service, socket_path=DEFAULT_SOCKET_PATH):
+        self.service = service
+        self.socket_path = socket_path
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._server = None
+
+    def handle_request(self, line, producer='default'):
+        """Runs one request. A request may name a stable producer (e.g.
+        telemetry), so repeated clients of the same kind share one queue
+        and its backpressure instead of getting a new one per connection.
+        """
+        try:
+            request = json.loads(line)
+            command = request['command']
+            params = request.get('params', {})
+            priority = request.get('priority')
+            producer = request.get('producer') or producer
+            if not isinstance(producer, str):
+                raise TypeError(f'producer must be a string: {producer!r}')
+        except (ValueError, KeyError, TypeError) as e:
+            return {'ok': False, 'error': f'malformed request: {e}'}
+        self.logger.info(f'request from {producer}: {command} {params}')
+        try:
+            result = self.service.call(
+                command, priority=priority, producer=producer, **params)
+        except Exception as e:
+            self.logger.exception(f'request {command} failed:')
+            return {'ok': False, 'error': str(e)}
+        return {'ok': True, 'result': result}
+
+    def serve_forever(self):
+        self.logger.info('*'*8 + ' starting modem daemon ' + '*'*8)
+        self._remove_stale_socket()
+        self._server = _UnixServer(self.socket_path, _RequestHandler)
+        self._server.modem_daemon = self
+        self._server.client_ids = count(1)
+        os.chmod(self.socket_path, 0o660)
+        self.logger.info(f'listening on {self.socket_path}')
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self.service.scheduler.stop()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _remove_stale_socket(self):
+        """Removes the socket left by a previous run, never a live one."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except FileNotFoundError:
+                return
+            except ConnectionRefusedError:
+                # nobody listening, a stale socket would make bind() fail
+                self.logger.info(f'removing stale socket {self.socket_path}')
+                os.unlink(self.socket_path)
+                return
+        raise ModemServiceError(
+            f'another daemon is already listening on {self.socket_path}')
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class ModemClient():
+    """Thin client for a running ModemDaemon.
+
+    Offers the same call() interface as ModemService so the cli doesn't
+    care whether it talks to the daemon or to the modem directly.
+    """
+
+    def __init__(
+        self,
+        socket_path=DEFAULT_SOCKET_PATH,
+        timeout=None,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        producer=None
+    ):
+        self.socket_path = socket_path
+        # name for the daemon's scheduler, the connection if None
+        self.producer = producer
+        # commands like a download may take minutes, so only connecting
+        # and ping are bounded by default
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    def is_available(self):
+        """True if a daemon answers on the socket, False if there is none.
+
+        Any other error (no permission, no answer in time) is raised, the
+        daemon may still be driving the modem.
+        """
+        try:
+            return self._exchange([('ping', {})], None, self.connect_timeout) == ['pong']
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+    def call(self, command, priority=None, **params):
+        return self.call_many([(command, params)], priority)[0]
+
+    def call_many(self, requests, priority=None):
+        """Sends all requests at once and returns their results in order."""
+        return self._exchange(requests, priority, self.timeout)
+
+    def _exchange(self, requests, priority, timeout):
+        if isinstance(priority, PRIORITY):
+            priority = priority.name
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.connect_timeout)
+            sock.connect(self.socket_path)
+            sock.settimeout(timeout)
+            payload = b''.join(
+                json.dumps(
+                    {'command': c, 'params': p, 'priority': priority,
+                     'producer': self.producer}
+                ).encode() + b'\n'
+                for c, p in requests
+            )
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+            results = []
+            with sock.makefile('rb') as f:
+                for _ in requests:
+                    line = f.readline()
+                    if not line:
+                        raise ModemServiceError('daemon closed connection')
+                    response = json.loads(line)
+                    if not response['ok']:
+                        raise ModemServiceError(response['error'])
+                    results.append(response['result'])
+            return results
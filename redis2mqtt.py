@@ -5,11 +5,15 @@ import time
 import logging
 import argparse
 import os
+import sys
+import json
+from datetime import datetime, timezone
 from logging.config import fileConfig
 from getmac import get_mac_address
 import redis
 from sim7080 import Sim7080
 from config import Config
+from modemd import ModemService, ModemDaemon, ModemClient
 
 
 CONFIG_BASE_PATH = 'conf/'
@@ -23,7 +27,7 @@ def connect_mqtt():
         logger.info('mqtt conf')
         # send_at('AT+SMCONF=?', 'OK', 1) # get mqtt configuration
         send_at(f'AT+SMCONF="CLIENTID","{_config["mqtt_clientid"]}"', 'OK', 1)
-        send_at(f'AT+SMCONF="URL","{_config["mqtt_server_host"]}",{_config["mqtt_server_port"]}', 'OK', 1)
+        send_at(f'AT+SMCONF="URL","{_config["mqtt_host"]}",{_config["mqtt_port"]}', 'OK', 1)
         # send_at('AT+SMCONF="URL","137.135.83.217",1883', 'OK', 1)
         send_at(f'AT+SMCONF="USERNAME","{_config["mqtt_user"]}"', 'OK', 1)
         send_at(f'AT+SMCONF="PASSWORD","{_config["mqtt_password"]}"', 'OK', 1)
@@ -60,6 +64,10 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers(help='commands', dest='command')
     parser_test= subparsers.add_parser('write_file', help="write file(s) to sim7080 module")
     parser_test.add_argument("filenames", nargs='*', help="name of the file(s) to send to sim7080", type=str)
+    parser_test= subparsers.add_parser('sync', help="upload file(s) that are missing or changed on sim7080 module")
+    parser_test.add_argument("filenames", nargs='*', help="name of the file(s) to sync to sim7080", type=str)
+    parser_test.add_argument("--verify", help="read back files to compare content, not only size", action="store_true")
+    parser_test.add_argument("--force", help="upload all files, even if unchanged", action="store_true")
     parser_test= subparsers.add_parser('delete_file', help="delete file(s) from sim7080 module")
     parser_test.add_argument("filenames", nargs='*', help="name of the file(s) to delete from sim7080", type=str)
     parser_test= subparsers.add_parser('download_file', help="download file using http from specified url")
@@ -69,6 +77,7 @@ if __name__ == '__main__':
     parser_test= subparsers.add_parser('send_status', help="send status message to mqtt")
     parser_test.add_argument("--message", help="optional message to sent with status message", type=str)
     parser_test= subparsers.add_parser('sync_time', help="sync local time with ntp")
+    parser_test= subparsers.add_parser('daemon', help="keep modem session open and serve requests from other commands")
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
     parser.add_argument("-t", "--test", help="don't send anything to mqtt", action="store_true")
     parser.add_argument("-o", "--keep_on", help="don't shut down modem after execution", action="store_true")
@@ -89,93 +98,128 @@ if __name__ == '__main__':
 
     # load settings
     path_app_config = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG_BASE_PATH, APP_CONFIG_FILE)
-    _config = Config().load_config(path_app_config)
+    _config = Config(path_app_config).load_config()
 
     # initialize
     if args.test:
             logger.info("Test mode - not sending anything to gdc...")
 
     r = redis.StrictRedis('localhost', 6379, charset="utf-8", decode_responses=True)
-    modem =  Sim7080(
-        _config['serial_port'], _config['serial_baud'], default_timeout=_config['serial_default_timeout'])
+    socket_path = _config['daemon_socket_path']
+
+    try:
+        daemon_running = ModemClient(socket_path).is_available()
+    except OSError as e:
+        # a daemon may be there, don't open the serial port beside it
+        logger.error(f'can\'t check for modem daemon at {socket_path}: {e}')
+        sys.exit(1)
+
+    if args.command == 'daemon':
+        # don't open the serial port while another daemon drives the modem
+        if daemon_running:
+            logger.error(f'modem daemon already running at {socket_path}')
+            sys.exit(1)
+        modem = Sim7080(
+            _config['serial_port'], _config['serial_baud'], default_timeout=_config['serial_default_timeout'])
+        service = ModemService(modem, _config)
+        # pick up config changes (file or SIGHUP) without restarting
+        _config.subscribe(service.apply_config_changes)
+        _config.watch()
+        daemon = ModemDaemon(service, socket_path)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('daemon stopped.')
+        finally:
+            if not args.keep_on:
+                modem.power_down()
+        sys.exit(0)
+
+    # use the warm modem session of a running daemon if there is one
+    modem = None
+    # one producer per command, so e.g. overlapping send_data runs share
+    # the daemon's queue for it
+    service = ModemClient(socket_path, producer=args.command)
+    if daemon_running:
+        logger.info(f'using modem daemon at {socket_path}')
+    else:
+        modem = Sim7080(
+            _config['serial_port'], _config['serial_baud'], default_timeout=_config['serial_default_timeout'])
+        service = ModemService(modem, _config)
 
     try:
         if args.command == 'write_file':
             logger.info('write_file')
-            for filename in args.filenames:
-                modem.write_file(filename)
+            # the daemon may run in another working directory, so send
+            # absolute paths and keep the given name for the module
+            requests = [
+                ('write_file', {'filename': os.path.abspath(f), 'remote_name': f})
+                for f in args.filenames
+            ]
+            if modem is None:
+                service.call_many(requests)
+            else:
+                for command, params in requests:
+                    service.call(command, **params)
+
+        elif args.command == 'sync':
+            logger.info('sync')
+            filenames = [(f, os.path.abspath(f)) for f in args.filenames]
+            results = service.call('sync_files', filenames=filenames, verify=args.verify, force=args.force)
+            for filename, result in results.items():
+                logger.info(f'{filename}: {result}')
 
         elif args.command == 'delete_file':
             logger.info('delete_file')
             for filename in args.filenames:
-                modem.delete_file(filename)
+                service.call('delete_file', filename=filename)
 
         elif args.command == 'download_file':
             for file_url in args.urls:
-                modem.download_file(file_url)
+                service.call('download_file', url=file_url)
 
         elif args.command == 'sync_time':
             logger.info('sync_time')
-            curr_time = modem.get_ntp_time(_config['ntp_server_host'])
+            curr_time = service.call('get_time')
             if curr_time:
-                set_time(curr_time)
+                set_time(datetime.fromtimestamp(curr_time / 1e6, timezone.utc))
                 logger.info('sync_time succeeded.')
             else:
                 logger.info('sync_time failed')
 
         elif args.command == 'send_status':
             logger.info('send_status')
-            if modem.modem_status < MODEM_STATUS.NETWORK_CONNECTED:
-                modem.connect_network(apn_name=_config['mobile_apn'])
-            while modem.modem_status !=  MODEM_STATUS.MQTT_CONNECTED:
-                modem.connect_mqtt(
-                    _config['mqtt_host'],
-                    _config['mqtt_port'],
-                    _config['mqtt_clientid'],
-                    _config['mqtt_ca_crt_filename'],
-                    _config['mqtt_client_cert_filename'],
-                    _config['mqtt_client_key_filename'],
-                    _config['mqtt_qos']
-                )
             if not args.test:
                 msg = prepare_status_msg()
                 if args.message:
                     msg['fields']['message'] = args.message
-                modem.mqtt_publish(_config['mqtt_publish_topic'], json.dumps([msg]))
+                service.call('publish', priority='interactive', message=json.dumps([msg]))
 
         elif args.command == 'send_data':
             logger.info('send_data')
             # get data from sqlite
             new_timestamp_entries = load_data_from_sqlite()
             logger.info(f'found {len(new_timestamp_entries)} new entries...')
-            if new_timestamp_entries:
-                if modem.modem_status < MODEM_STATUS.NETWORK_CONNECTED:
-                    modem.connect_network(apn_name=NETWORK_APN)
-                if modem.modem_status !=  MODEM_STATUS.MQTT_CONNECTED:
-                    while modem.modem_status !=  MODEM_STATUS.MQTT_CONNECTED:
-                        modem.connect_mqtt(
-                            MQTT_HOST,
-                            MQTT_PORT,
-                            device_name,
-                            CA_CRT_FILENAME,
-                            CLIENT_CRT_FILENAME,
-                            CLIENT_KEY_FILENAME,
-                            MQTT_QOS
-                        )
-                while new_timestamp_entries:
-                    ids = []
-                    msg = []
-                    for entry in new_timestamp_entries:
-                        ids.append(entry[0])
-                        msg.append(prepare_timestamp_msg(entry[1], entry[2], entry[3]))
-                    if not args.test:
-                        logger.info(f'start publishing {len(msg)} new entries...')
-                        if modem.mqtt_publish(MQTT_PUBLISH_TOPIC, json.dumps(msg)):
-                            delete_data_from_sqlite(ids)
-                    new_timestamp_entries = load_data_from_sqlite()
-        if not args.keep_on:
+            while new_timestamp_entries:
+                ids = []
+                msg = []
+                for entry in new_timestamp_entries:
+                    ids.append(entry[0])
+                    msg.append(prepare_timestamp_msg(entry[1], entry[2], entry[3]))
+                if not args.test:
+                    logger.info(f'start publishing {len(msg)} new entries...')
+                    # the service splits them into batches of mqtt_batch_size
+                    published = service.call('publish_batch', messages=msg)
+                    if published:
+                        delete_data_from_sqlite(ids[:published])
+                    if published < len(msg):
+                        logger.error(f'published only {published} of {len(msg)} entries.')
+                        break
+                new_timestamp_entries = load_data_from_sqlite()
+        # the daemon owns the modem, only power down what we started ourselves
+        if modem is not None and not args.keep_on:
             modem.power_down()
     except:
         logger.exception('Exception occured:')
         if modem != None:
-            modem.power_down()
\ No newline at end of file
+            modem.power_down()
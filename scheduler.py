@@ -0,0 +1,179 @@
+"""This module serializes access to a shared sim7080 modem.
+
+Producers (telemetry, time sync, status messages, bulk event publishing)
+submit transactions, i.e. callables that get the modem as their only
+argument and may issue any number of at commands. A single worker runs
+them one after another, so multi-step exchanges like AT+SMPUB plus
+payload never interleave with other commands. A transaction holds the
+modem until it returns, so long operations (connecting, downloads, file
+uploads) should be submitted as a series of short transactions."""
+
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from enum import IntEnum
+
+DEFAULT_MAX_QUEUE_SIZE = 32
+# bound over all producers, each daemon connection may be one
+DEFAULT_MAX_PENDING = 128
+DEFAULT_MAX_SKIPS = 8
+
+
+class PRIORITY(IntEnum):
+    CONTROL = 0
+    INTERACTIVE = 1
+    BULK = 2
+
+
+class _Job():
+    def __init__(self, transaction, priority, producer):
+        self.transaction = transaction
+        self.priority = priority
+        self.producer = producer
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class CommandScheduler():
+    """Runs modem transactions by priority class, fair between producers.
+
+    Within a priority class every producer has its own bounded queue and
+    producers are served round robin, so one busy producer can't starve
+    the others. Higher classes go first, but a class that was passed over
+    max_skips times in a row gets one turn, so bulk traffic keeps moving
+    while control and interactive requests stay ahead of it.
+    A full queue, or max_pending jobs waiting in total, blocks the
+    producer (backpressure) or raises queue.Full if block is False or the
+    timeout expires.
+    """
+
+    def __init__(
+        self,
+        modem,
+        max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+        max_skips=DEFAULT_MAX_SKIPS,
+        max_pending=DEFAULT_MAX_PENDING
+    ):
+        self.modem = modem
+        self.max_queue_size = max_queue_size
+        self.max_pending = max_pending
+        self.max_skips = max_skips
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._cond = threading.Condition()
+        # priority -> producer -> deque of jobs, producers in round robin order
+        self._queues = {p: OrderedDict() for p in PRIORITY}
+        self._skips = {p: 0 for p in PRIORITY}
+        self._pending = 0
+        self._running = False
+        self._stopped = False
+        self._worker = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopped = False
+        self._worker = threading.Thread(
+            target=self._run, name='CommandScheduler', daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def submit(
+        self,
+        transaction,
+        priority=PRIORITY.INTERACTIVE,
+        producer='default',
+        block=True,
+        timeout=None
+    ) -> Future:
+        job = _Job(transaction, PRIORITY(priority), producer)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            # nobody would ever run the job
+            if self._stopped:
+                raise RuntimeError('scheduler is stopped')
+            while (self._queue_len(job.priority, producer) >= self.max_queue_size
+                   or self._pending >= self.max_pending):
+                if not block:
+                    raise queue.Full()
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Full()
+                self._cond.wait(remaining)
+                if self._stopped:
+                    raise RuntimeError('scheduler is stopped')
+            self._queues[job.priority].setdefault(producer, deque()).append(job)
+            self._pending += 1
+            self._cond.notify_all()
+        return job.future
+
+    def run(self, transaction, priority=PRIORITY.INTERACTIVE, producer='default'):
+        """Submits a transaction and waits for its result."""
+        return self.submit(transaction, priority, producer).result()
+
+    def pending(self):
+        with self._cond:
+            return self._pending
+
+    def _queue_len(self, priority, producer):
+        q = self._queues[priority].get(producer)
+        return len(q) if q else 0
+
+    def _next_job(self):
+        waiting = [p for p in PRIORITY if self._queues[p]]
+        if not waiting:
+            return None
+        priority = waiting[0]
+        for p in reversed(waiting[1:]):
+            if self._skips[p] >= self.max_skips:
+                priority = p
+                break
+        for p in waiting:
+            self._skips[p] = 0 if p == priority else self._skips[p] + 1
+        producers = self._queues[priority]
+        producer, jobs = next(iter(producers.items()))
+        job = jobs.popleft()
+        self._pending -= 1
+        # rotate the producer to the end so the next one gets a turn
+        del producers[producer]
+        if jobs:
+            producers[producer] = jobs
+        return job
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None and self._running:
+                    self._cond.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                # a queue slot was freed, wake up blocked producers
+                self._cond.notify_all()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            self.logger.debug(
+                f'running {job.priority.name} job from {job.producer} '
+                f'(waited {time.monotonic() - job.submitted:.3f}s)')
+            try:
+                with self.modem.transaction():
+                    result = job.transaction(self.modem)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
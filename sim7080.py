@@ -1,15 +1,26 @@
 #!/usr/bin/python
 
+import re
 import serial
 import time
 import logging
+import threading
+from contextlib import contextmanager
 from urllib.parse import urlparse
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 from enum import Enum, IntEnum
 
 POWER_KEY = 4
 DEFAULT_TIMEOUT = 1
+FILE_CHUNK_SIZE = 1024
+DOWNLOAD_FILENAME = 'foo.bin'
+# +CCLK: "yy/MM/dd,hh:mm:ss±zz", zz in quarters of an hour
+CLOCK_PATTERN = re.compile(
+    r'(\d{2})/(\d{2})/(\d{2}),(\d{2}):(\d{2}):(\d{2})([+-]\d{1,2})?')
+# unsolicited messages sent with AT+CLTS=1 when the network updated the clock
+NETWORK_TIME_URCS = ('*PSUTTZ', '+CTZV', 'DST:')
 
 
 class MODEM_STATUS(IntEnum):
@@ -57,16 +68,49 @@ class Response():
 class Sim7080:
 
     modem_status = None
+    # connect attempts of ensure_network(), None retries forever
+    network_attempts = None
 
     def __init__(self, port, baud, default_timeout=DEFAULT_TIMEOUT):
         self.ser = serial.Serial(port, baud, timeout=default_timeout)
+        self.default_timeout = default_timeout
+        # guards the serial line. reentrant so a transaction can span
+        # several commands issued by the same thread.
+        self._lock = threading.RLock()
+        self._file_session_depth = 0
         self.ser.flushInput()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.modem_status = MODEM_STATUS.PWR_OFF
+        # monotonic time of the last network time update seen, if any
+        self.network_time_at = None
         r = self._send_execute_command('ATE0')
         if r.is_success():
             self._sync_modem_status()
 
+    @contextmanager
+    def transaction(self):
+        """Keeps other threads off the serial line for a multi-step exchange."""
+        with self._lock:
+            yield self
+
+    @contextmanager
+    def file_session(self):
+        """Wraps file system commands in one AT+CFSINIT/AT+CFSTERM pair.
+
+        Nested sessions reuse the outer one, so several file operations
+        can share a single init.
+        """
+        with self.transaction():
+            if self._file_session_depth == 0:
+                self._send_execute_command('AT+CFSINIT')
+            self._file_session_depth += 1
+            try:
+                yield self
+            finally:
+                self._file_session_depth -= 1
+                if self._file_session_depth == 0:
+                    self._send_execute_command('AT+CFSTERM')
+
     def is_powered_on(self):
         if self._send_execute_command('ATE0').is_success():
             return True
@@ -104,6 +148,7 @@ class Sim7080:
 
     def ensure_network(self):
         self._sync_modem_status()
+        attempts = 0
         while 1:
             if self.modem_status >= MODEM_STATUS.NETWORK_CONNECTED:
                 self.logger.info('sim7080 is connected to network.')
@@ -113,9 +158,14 @@ class Sim7080:
                 self.ensure_power()
                 self.logger.info('try connect to network')
                 self.connect_network()
+                attempts += 1
                 if self.modem_status >= MODEM_STATUS.NETWORK_CONNECTED:
                     self.logger.info('sim7080 is connected to network.')
                     return True
+                elif (self.network_attempts is not None
+                        and attempts >= self.network_attempts):
+                    self.logger.info('giving up.')
+                    return False
                 else:
                     self.logger.info('trying again...')
                     time.sleep(10)
@@ -137,8 +187,7 @@ class Sim7080:
         self.logger.debug('Base station Location configure')
         self._send_write_command('AT+CLBSCFG', f'0,3')
         self.logger.debug('Base station Location')
-        self._send_write_command('AT+CLBS', f'1,{cid}')
-        resp = self._wait_for_message('', timeout=10)
+        resp = self._send_write_command('AT+CLBS', f'1,{cid}', timeout=10)
         if resp.is_success() and resp.message[0].startswith('0,'):
             response_fields = [
                 "Error Code",
@@ -159,8 +208,20 @@ class Sim7080:
             )
             return pos_dict
         else:
-            self.logger.error(f'failed to sync time. error msg: {resp.message[0]}')
+            self.logger.error(f'failed to get location. error msg: {resp.message}')
             return None
+
+    def get_serving_cell(self):
+        """Returns (MCC-MNC, TAC, SCellID) of the serving cell or None."""
+        res = self._send_read_command('AT+CPSI')
+        if res.is_error():
+            return None
+        for line in res.message:
+            # e.g. 'LTE CAT-M1,Online,228-01,0x1A2B,21299722,...'
+            fields = line.split(',')
+            if len(fields) >= 5 and fields[1] == 'Online':
+                return fields[2], fields[3], fields[4]
+        return None
         
     def get_network_info(self):
         self.logger.info('*'*8 + ' get network info' + '*'*8)
@@ -196,11 +257,11 @@ class Sim7080:
             return res_dict
         return False
 
-    def connect_network(self, apn_name=''):
+    def connect_network(self, apn_name='', preferred_mode=1):
         self.ensure_power()
         self.logger.info('*'*8 + ' connecting to network' + '*'*8)
         self.logger.debug('Preferred Selection between CAT-M and NB-IoT')
-        self._send_write_command('AT+CMNB', '1')
+        self._send_write_command('AT+CMNB', f'{preferred_mode}')
         if apn_name == '':
             self.logger.debug('Get Network APN in CAT-M or NB-IOT')
             resp = self._send_execute_command('AT+CGNAPN')
@@ -228,7 +289,11 @@ class Sim7080:
         ca_crt_filename,
         client_crt_filename,
         client_key_filename,
-        qos
+        qos,
+        username='',
+        password='',
+        keeptime=60,
+        cleanss=1
     ):
         self.logger.info('*'*8 + ' connecting mqtt' + '*'*8)
         self.logger.info(f'host: {host}, port: {port}, client-id: {clientid}')
@@ -239,10 +304,13 @@ class Sim7080:
             return True
         self._send_write_command('AT+CMEE', '2')
         self._send_write_command('AT+SMCONF', f'"URL","{host}",{port}')
-        self._send_write_command('AT+SMCONF', '"KEEPTIME",60')
-        self._send_write_command('AT+SMCONF', '"CLEANSS",1')
+        self._send_write_command('AT+SMCONF', f'"KEEPTIME",{keeptime}')
+        self._send_write_command('AT+SMCONF', f'"CLEANSS",{cleanss}')
         self._send_write_command('AT+SMCONF', f'"QOS",{qos}')
         self._send_write_command('AT+SMCONF', f'"CLIENTID","{clientid}"')
+        if username:
+            self._send_write_command('AT+SMCONF', f'"USERNAME","{username}"')
+            self._send_write_command('AT+SMCONF', f'"PASSWORD","{password}"')
         resp = self._send_write_command(
             'AT+CSSLCFG', f'"convert",2,"{ca_crt_filename}"')
         if resp.is_error():
@@ -297,12 +365,12 @@ class Sim7080:
         self.logger.warn('connection to http server failed!')
         return False
 
-    def download_file(
+    def http_request(
         self,
         url : str
     ):
-        file_chunk_size = 1024
-        self.logger.info('*'*8 + ' download_file ' + '*'*8)
+        """Sends a GET request. Returns the length of the body or None."""
+        self.logger.info('*'*8 + ' http_request ' + '*'*8)
         self.logger.info(f'url: {url}')
         self.ensure_network()
         parsed_uri = urlparse(url)
@@ -311,66 +379,115 @@ class Sim7080:
         self._send_write_command('AT+SHAHEAD', '"User-Agent","IOE Client"')
         self._send_write_command('AT+SHAHEAD', '"Connection","keep-alive"')
         self._send_write_command('AT+SHAHEAD', '"Cache-control","no-cache"')
-        self._send_write_command('AT+SHREQ', f'"{url}",1')
-        resp = self._wait_for_message('+SHREQ', timeout=10)
+        with self.transaction():
+            self._send_write_command('AT+SHREQ', f'"{url}",1')
+            resp = self._wait_for_message('+SHREQ', timeout=10)
         if resp.is_success():
             error_code = int(resp.message[0].split(',')[1])
             self.logger.debug(f'error code is {error_code}')
             if (error_code == 200):
                 data_length = int(resp.message[0].split(',')[2])
                 self.logger.debug(f'data length is {data_length}')
-                with open("foo.bin", "wb") as newFile:
-                    start_idx = 0
-                    while start_idx < data_length:
-                        if data_length - start_idx < file_chunk_size:
-                            file_chunk_size = data_length - start_idx
-                        resp = self._send_write_command('AT+SHREAD', f'{start_idx},{file_chunk_size}')
-                        if resp.is_success():
-                            data_head = self._wait_for_message('+SHREAD')
-                            data_content =  self.ser.read(file_chunk_size)
-                            self.logger.debug(f'data_part is {data_content}')
-                            newFile.write(bytearray(data_content))
-                            start_idx += file_chunk_size 
-            return True
-            
-        self.logger.warn('download file failed!')
-        return False
+                return data_length
+        self.logger.warn('http request failed!')
+        return None
+
+    def http_read(self, start_idx, size):
+        """Returns a chunk of the body of the last http request or None."""
+        with self.transaction():
+            resp = self._send_write_command('AT+SHREAD', f'{start_idx},{size}')
+            if resp.is_error():
+                return None
+            self._wait_for_message('+SHREAD')
+            data_content = self._read_raw_data(size)
+        self.logger.debug(f'data_part is {data_content}')
+        return data_content
+
+    def download_file(
+        self,
+        url : str,
+        filename=DOWNLOAD_FILENAME
+    ):
+        self.logger.info('*'*8 + ' download_file ' + '*'*8)
+        data_length = self.http_request(url)
+        if data_length is None:
+            self.logger.warn('download file failed!')
+            return False
+        with open(filename, "wb") as newFile:
+            start_idx = 0
+            while start_idx < data_length:
+                size = min(FILE_CHUNK_SIZE, data_length - start_idx)
+                # hold the line per chunk only, other commands may run in between
+                data_content = self.http_read(start_idx, size)
+                if data_content is None:
+                    self.logger.warn('download file failed!')
+                    return False
+                newFile.write(data_content)
+                start_idx += size
+        return True
 
     def check_if_file_exists(self, filename):
         self.logger.info('*'*8 + ' check if file exists' + '*'*8)
         self.logger.info(f'file: {filename}')
-        self.ensure_power()
-        res = self._send_write_command('AT+CFSGFIS', f'3,"{filename}"')
-        if not res.is_error():
-            filesize = int(res.message[0])
-            self.logger.debug(f'file size is {filesize}')
-            if filesize > 0:
-                self.logger.info(f'file: {filename} exists.')
-                return True
+        filesize = self.get_file_size(filename)
+        if filesize:
+            self.logger.info(f'file: {filename} exists.')
+            return True
         else:
             self.logger.info(f'file: {filename} does not exist.')
             return False
 
-    def write_file(self, filename):
-        self.logger.info('*'*8 + ' write file' + '*'*8)
+    def get_file_size(self, filename):
+        """Returns the size of a file in the customer directory or None."""
+        self.ensure_power()
+        with self.file_session():
+            res = self._send_write_command('AT+CFSGFIS', f'3,"{filename}"')
+        if res.is_error():
+            return None
+        filesize = int(res.message[0])
+        self.logger.debug(f'file size of {filename} is {filesize}')
+        return filesize
+
+    def read_file(self, filename, size):
+        """Returns up to size bytes of a file in the customer directory."""
+        self.logger.info('*'*8 + ' read file' + '*'*8)
         self.logger.info(f'file: {filename}')
         self.ensure_power()
-        with open(filename) as f:
+        with self.file_session():
+            res = self._send_write_command(
+                'AT+CFSRFILE', f'3,"{filename}",0,{size},0',
+                end_str='+CFSRFILE')
+            if res.is_error():
+                return None
+            data = self._read_raw_data(int(res.message[-1]))
+            self._wait_for_message('OK')
+        return data
+
+    def write_file(self, filename, remote_name=None):
+        """Uploads a local file, stored as remote_name (default: filename)."""
+        if remote_name is None:
+            remote_name = filename
+        self.logger.info('*'*8 + ' write file' + '*'*8)
+        self.logger.info(f'file: {filename} -> {remote_name}')
+        self.ensure_power()
+        with open(filename, 'rb') as f:
             content = f.read()
         self.logger.debug(f'file content: {content}')
-        self._send_execute_command('AT+CFSINIT')
-        self._send_test_command(f'AT+CFSWFILE')
-        self._send_write_command(
-            'AT+CFSWFILE', f'3,"{filename}",0,{len(content)},9999')
-        self._send_execute_command(content)
-        self._send_execute_command('AT+CFSTERM')
-        return True
+        with self.file_session():
+            resp = self._send_write_command(
+                'AT+CFSWFILE', f'3,"{remote_name}",0,{len(content)},9999',
+                end_str='DOWNLOAD')
+            if resp.is_error():
+                return False
+            resp = self._send_raw_data(content, timeout=10)
+        return resp.is_success()
 
     def delete_file(self, filename):
         self.logger.info('*'*8 + ' delete file' + '*'*8)
         self.logger.info(f'file: {filename}')
         self.ensure_power()
-        self._send_write_command('AT+CFSDFILE', f'3,"{filename}"')
+        with self.file_session():
+            self._send_write_command('AT+CFSDFILE', f'3,"{filename}"')
         return True
 
     def get_ntp_time(self, ntp_server):
@@ -380,26 +497,78 @@ class Sim7080:
         self._send_execute_command('AT+CNTP')
         resp = self._wait_for_message('+CNTP', timeout=10)
         if resp.is_success() and resp.message[0].startswith('1,'):
-            self.logger.debug('Get Module Time')
-            time_resp = self._send_read_command('AT+CCLK')
-            module_date = time_resp.message[0][1:9]
-            module_time = time_resp.message[0][10:18]
-            date_time_obj = datetime.strptime(
-                f'{module_date} {module_time}', '%y/%m/%d %H:%M:%S')
+            date_time_obj = self.get_clock()
             self.logger.info(f'time synced: current time is: {str(date_time_obj)}')
             return date_time_obj
         else:
             self.logger.error(f'failed to sync time. error msg: {resp.message[0]}')
             return None
 
+    def get_clock(self):
+        """Returns the module's real time clock as aware datetime in utc."""
+        self.logger.debug('Get Module Time')
+        resp = self._send_read_command('AT+CCLK')
+        if resp.is_error():
+            return None
+        for line in resp.message:
+            match = CLOCK_PATTERN.search(line)
+            if match:
+                yy, mm, dd, h, m, sec, quarters = match.groups()
+                offset = timedelta(minutes=15 * int(quarters or 0))
+                clock = datetime(
+                    2000 + int(yy), int(mm), int(dd), int(h), int(m), int(sec),
+                    tzinfo=timezone(offset))
+                return clock.astimezone(timezone.utc)
+        self.logger.warn(f'unexpected clock format: {resp.message}')
+        return None
+
+    def enable_network_time(self):
+        """Lets the network update the module clock (NITZ).
+
+        Returns True if the setting is active. The module picks up network
+        time on the next registration after enabling it, if the network
+        sends it at all; network_time_at tells when it last arrived.
+        """
+        resp = self._send_read_command('AT+CLTS')
+        if resp.is_success() and resp.message[0].strip() == '1':
+            return True
+        self.logger.debug('Enable Get Local Timestamp')
+        return self._send_write_command('AT+CLTS', '1').is_success()
+
     def mqtt_publish(self, topic, elem):
         self.logger.info('*'*8 + ' mqtt_publish ' + '*'*8)
         self.ensure_network()
         self.logger.debug(f'mqtt message: \'{elem}\'')
-        self._send_write_command('AT+SMPUB', f'"{topic}",{len(elem)},1,0')
-        res = self._send_execute_command(elem, timeout=10)
+        with self.transaction():
+            self._send_write_command('AT+SMPUB', f'"{topic}",{len(elem)},1,0')
+            res = self._send_execute_command(elem, timeout=10)
         return res.is_success()
 
+    def disconnect_mqtt(self):
+        self.logger.info('*'*8 + ' disconnect mqtt ' + '*'*8)
+        self._send_execute_command('AT+SMDISC')
+        if self.modem_status > MODEM_STATUS.NETWORK_CONNECTED:
+            self.modem_status = MODEM_STATUS.NETWORK_CONNECTED
+        return True
+
+    def disconnect_network(self):
+        self.logger.info('*'*8 + ' disconnect network ' + '*'*8)
+        self.disconnect_mqtt()
+        self._send_write_command('AT+CNACT', '0,0')
+        if self.modem_status > MODEM_STATUS.PWR_ON:
+            self.modem_status = MODEM_STATUS.PWR_ON
+        return True
+
+    def power_down(self):
+        self.logger.info('*'*8 + ' power down ' + '*'*8)
+        resp = self._send_write_command(
+            'AT+CPOWD', '1', timeout=5, end_str='NORMAL POWER DOWN')
+        if resp.is_success():
+            self.modem_status = MODEM_STATUS.PWR_OFF
+        else:
+            self.logger.warn('power down failed!')
+        return resp.is_success()
+
     def ping(self, hostname):
         """Pings the host with the SIM7080 module."""
         self.logger.info(f'{"*"*8} ping {"*"*8}')
@@ -437,66 +606,72 @@ class Sim7080:
         self._send_at_cmd('AT+CPSI?')
 
     def __send_at_cmd(self, at_cmd, end_str='OK', timeout=DEFAULT_TIMEOUT) -> Response:
-        self.logger.debug(f'request  : {str(at_cmd)}')
-        if timeout != DEFAULT_TIMEOUT:
-            self.ser.timeout = timeout
-        # check if unsolicited message is waiting
-        while self.ser.inWaiting():
-            msg = str(self.ser.read_until(b'\r\n'))
-            self.logger.debug('unsolicited message from device :' + msg)
-        self.ser.write((at_cmd + '\r\n').encode())
-        response = Response()
-        while 1:
-            line = self.ser.read_until(b'\r\n')
-            if line == b'':
-                self.logger.debug('TIMEOUT!')
-                response.error_code = 'TIMEOUT'
-                break
-            line = line.decode().strip('\r\n')
-            if line == '':
-                continue
-            response._raw_message.append(line)
-            if line.startswith('+CME ERROR: '):
-                response.error_code = 'ERROR'
-                break
-            if line.startswith(end_str):
-                response.error_code = 'OK'
-                break
-            if line.startswith('ERROR'):
-                response.error_code = 'ERROR'
-                break
-        self.logger.debug('raw response :' + str(response._raw_message))
-        self.ser.timeout = DEFAULT_TIMEOUT
-        return response
+        with self._lock:
+            self.logger.debug(f'request  : {str(at_cmd)}')
+            # check if unsolicited message is waiting
+            while self.ser.inWaiting():
+                msg = self.ser.read_until(b'\r\n')
+                self.logger.debug('unsolicited message from device :' + str(msg))
+                self._check_urc(msg.decode(errors='replace').strip())
+            self.ser.write((at_cmd + '\r\n').encode())
+            return self.__read_response(end_str, timeout)
 
     def __wait_for_msg(self, msg, timeout=DEFAULT_TIMEOUT) -> Response:
-        self.logger.debug(f'wait for message  : {str(msg)}')
-        if timeout != DEFAULT_TIMEOUT:
-            self.ser.timeout = timeout
+        with self._lock:
+            self.logger.debug(f'wait for message  : {str(msg)}')
+            return self.__read_response(msg, timeout)
+
+    def __read_response(self, end_str, timeout) -> Response:
+        # caller holds the lock, so the timeout can't leak into other commands
+        self.ser.timeout = timeout
         response = Response()
-        while 1:
-            line = self.ser.read_until(b'\r\n')
-            if line == b'':
-                self.logger.debug('TIMEOUT!')
-                response.error_code = 'TIMEOUT'
-                break
-            line = line.decode().strip('\r\n')
-            if line == '':
-                continue
-            response._raw_message.append(line)
-            if line.startswith('+CME ERROR: '):
-                response.error_code = 'ERROR'
-                break
-            if line.startswith(msg):
-                response.error_code = 'OK'
-                break
-            if line.startswith('ERROR'):
-                response.error_code = 'ERROR'
-                break
+        try:
+            while 1:
+                line = self.ser.read_until(b'\r\n')
+                if line == b'':
+                    self.logger.debug('TIMEOUT!')
+                    response.error_code = 'TIMEOUT'
+                    break
+                line = line.decode().strip('\r\n')
+                if line == '':
+                    continue
+                response._raw_message.append(line)
+                self._check_urc(line)
+                if line.startswith('+CME ERROR: '):
+                    response.error_code = 'ERROR'
+                    break
+                if line.startswith(end_str):
+                    response.error_code = 'OK'
+                    break
+                if line.startswith('ERROR'):
+                    response.error_code = 'ERROR'
+                    break
+        finally:
+            self.ser.timeout = self.default_timeout
         self.logger.debug('raw response :' + str(response._raw_message))
-        self.ser.timeout = DEFAULT_TIMEOUT
         return response
 
+    def _check_urc(self, line):
+        if line.startswith(NETWORK_TIME_URCS):
+            self.logger.debug('network time received')
+            self.network_time_at = time.monotonic()
+
+    def _send_raw_data(self, data, timeout=DEFAULT_TIMEOUT) -> Response:
+        with self._lock:
+            self.logger.debug(f'raw data : {len(data)} bytes')
+            self.ser.write(data)
+            return self.__read_response('OK', timeout)
+
+    def _read_raw_data(self, size) -> bytes:
+        with self._lock:
+            # ~10 bits per byte on the line, plus some slack
+            self.ser.timeout = max(
+                self.default_timeout, size * 10 / self.ser.baudrate + 1)
+            try:
+                return self.ser.read(size)
+            finally:
+                self.ser.timeout = self.default_timeout
+
     def _send_test_command(self, command, timeout=DEFAULT_TIMEOUT) -> Response:
         resp = self.__send_at_cmd(command + '=?', timeout=timeout)
         resp.message = resp._raw_message
@@ -518,9 +693,11 @@ class Sim7080:
         self,
         command,
         parameters,
-        timeout=DEFAULT_TIMEOUT
+        timeout=DEFAULT_TIMEOUT,
+        end_str='OK'
     ) -> Response:
-        resp = self.__send_at_cmd(command + '=' + parameters, timeout=timeout)
+        resp = self.__send_at_cmd(
+            command + '=' + parameters, end_str=end_str, timeout=timeout)
         for line in resp._raw_message:
             if line.startswith(command[2:] + ':'):
                 resp.message.append(line[len(command):])
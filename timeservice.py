@@ -0,0 +1,178 @@
+"""This module provides timestamps from the modem clock without an at
+round trip per call.
+
+The offset between modem time and the host's monotonic clock is cached
+together with the time it was measured. Between syncs the offset is
+extrapolated with an estimated drift, and the estimate's error grows with
+the time since the last sync. Only when it passes max_error the service
+syncs again. The module clock is only trusted as a sample if the network
+updated it (NITZ, AT+CLTS) since the previous sample, otherwise it is
+free running and the service syncs it with ntp first."""
+
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+DEFAULT_MAX_ERROR = 1.0
+# drift assumed before there are two samples to estimate it from, and the
+# residual uncertainty once there are (host crystals are good to ~50 ppm)
+DEFAULT_DRIFT_UNCERTAINTY = 50e-6
+ESTIMATED_DRIFT_UNCERTAINTY = 5e-6
+# samples closer together than this say more about noise than drift
+MIN_DRIFT_INTERVAL = 600
+DRIFT_SMOOTHING = 0.3
+# the module clock only has second resolution; poll for the next tick
+# to get the second boundary down to one round trip
+CLOCK_EDGE_TIMEOUT = 1.1
+# don't repeat a failed sync (possibly a slow ntp round trip) right away
+RETRY_INTERVAL = 60
+# the module clock starts at 80/01/06 until it gets network or ntp time
+VALID_YEARS = range(2020, 2070)
+
+
+class TimeService():
+
+    def __init__(
+        self,
+        modem,
+        ntp_server,
+        max_error=DEFAULT_MAX_ERROR
+    ):
+        self.modem = modem
+        self.ntp_server = ntp_server
+        self.max_error = max_error
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._offset = None
+        self._sampled_at = None
+        self._sample_error = None
+        self._drift = 0.0
+        self._drift_estimated = False
+        self._network_time = False
+        self._failed_at = None
+
+    def is_synced(self):
+        return self._offset is not None
+
+    def error_estimate(self):
+        """Upper bound of the current timestamp error in seconds."""
+        with self._lock:
+            if self._offset is None:
+                return float('inf')
+            uncertainty = (ESTIMATED_DRIFT_UNCERTAINTY if self._drift_estimated
+                           else DEFAULT_DRIFT_UNCERTAINTY)
+            elapsed = time.monotonic() - self._sampled_at
+            return self._sample_error + uncertainty * elapsed
+
+    def needs_sync(self):
+        return self.error_estimate() > self.max_error
+
+    def should_sync(self):
+        """needs_sync(), unless the last attempt failed only recently."""
+        if (self._failed_at is not None
+                and time.monotonic() - self._failed_at < RETRY_INTERVAL):
+            return False
+        return self.needs_sync()
+
+    def now(self):
+        """Current time in seconds since the epoch, None if never synced."""
+        with self._lock:
+            if self._offset is None:
+                return None
+            mono = time.monotonic()
+            return mono + self._offset + self._drift * (mono - self._sampled_at)
+
+    def now_us(self):
+        """Current time in microseconds since the epoch, None if never synced."""
+        now = self.now()
+        return None if now is None else int(now * 1e6)
+
+    def now_datetime(self):
+        now = self.now()
+        return None if now is None else datetime.fromtimestamp(now, timezone.utc)
+
+    def sync(self):
+        """Takes a new sample from the modem. Needs exclusive modem access.
+
+        Returns True if the cached offset was updated.
+        """
+        self.logger.info('*'*8 + ' sync time service ' + '*'*8)
+        if self._sync():
+            self._failed_at = None
+            return True
+        self._failed_at = time.monotonic()
+        return False
+
+    def _sync(self):
+        # only a successful setting is kept, otherwise try again next time
+        if not self._network_time:
+            self._network_time = self.modem.enable_network_time()
+        sample = None
+        if self._network_time and self._has_new_network_time():
+            sample = self._sample_clock()
+            if sample is None:
+                self.logger.info('no network time on module clock.')
+        if sample is None:
+            self.logger.info(f'falling back to ntp ({self.ntp_server})')
+            if self.modem.get_ntp_time(self.ntp_server) is None:
+                return False
+            sample = self._sample_clock()
+            if sample is None:
+                return False
+        self._update(*sample)
+        return True
+
+    def _has_new_network_time(self):
+        # without an update the module clock just runs on from the last
+        # sample and would only confirm our own estimate
+        received = self.modem.network_time_at
+        if received is None:
+            self.logger.info('no network time received.')
+            return False
+        if self._sampled_at is not None and received <= self._sampled_at:
+            self.logger.info('no network time received since last sync.')
+            return False
+        return True
+
+    def _sample_clock(self):
+        """Returns (modem time, monotonic time, error) or None."""
+        before = time.monotonic()
+        clock = self.modem.get_clock()
+        after = time.monotonic()
+        if clock is None or clock.year not in VALID_YEARS:
+            return None
+        # without an edge the reading could be anywhere in its second
+        sample = (clock.timestamp() + 0.5, (before + after) / 2,
+                  0.5 + (after - before) / 2)
+        deadline = after + CLOCK_EDGE_TIMEOUT
+        while time.monotonic() < deadline:
+            before = time.monotonic()
+            tick = self.modem.get_clock()
+            after = time.monotonic()
+            if tick is None:
+                break
+            if tick != clock:
+                # the second changed since the previous poll, about one
+                # round trip ago
+                return tick.timestamp(), (before + after) / 2, after - before
+        return sample
+
+    def _update(self, modem_time, sampled_at, error):
+        offset = modem_time - sampled_at
+        with self._lock:
+            if self._offset is not None:
+                interval = sampled_at - self._sampled_at
+                if interval >= MIN_DRIFT_INTERVAL:
+                    drift = (offset - self._offset) / interval
+                    if self._drift_estimated:
+                        drift = (DRIFT_SMOOTHING * drift
+                                 + (1 - DRIFT_SMOOTHING) * self._drift)
+                    self._drift = drift
+                    self._drift_estimated = True
+            self._offset = offset
+            self._sampled_at = sampled_at
+            self._sample_error = error
+        self.logger.info(
+            f'time synced: offset {offset:.3f}s, error {error:.3f}s, '
+            f'drift {self._drift * 1e6:.1f}ppm')